@@ -1,12 +1,31 @@
-from mcp.server.fastmcp import FastMCP
+from mcp.server.fastmcp import Context, FastMCP
 import os
 import httpx
+import diskcache
+import numpy as np
+import orjson
 from dotenv import load_dotenv
 from groundx import GroundX, Document
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 import openai
-from typing import Optional
+from typing import Any, NamedTuple, Optional
 import asyncio
+import atexit
+import hashlib
+import logging
+import math
+import re
+import signal
+import threading
+import time
+from collections import OrderedDict, deque
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+
+try:
+    import uvloop
+except ImportError:  # uvloop does not support Windows
+    uvloop = None
 
 load_dotenv()
 
@@ -14,9 +33,73 @@ weather_api_key = os.getenv("WEATHER_API_KEY")
 brave_api_key = os.getenv("BRAVE_API_KEY")
 groundx_api_key = os.getenv("GROUNDX_API_KEY")
 openai_api_key = os.getenv("OPENAI_API_KEY")
+BUCKET_ID = int(os.getenv("BUCKET_ID")) if os.getenv("BUCKET_ID") else None
+COMPLETION_MODEL = os.getenv("COMPLETION_MODEL", "gpt-4o")
+CACHE_DEBUG = os.getenv("CACHE_DEBUG", "").lower() in ("1", "true", "yes")
 
+logger = logging.getLogger(__name__)
 
-mcp = FastMCP("Multiple MCP tools including RAG in single MCP server")
+
+@asynccontextmanager
+async def _lifespan(server: FastMCP) -> AsyncIterator[None]:
+    """
+    Run the note flusher for as long as the server is up. Going through the
+    FastMCP lifespan means it also runs under `mcp dev` and `mcp run`, which
+    never call main().
+    """
+    flusher = asyncio.create_task(_flush_loop())
+    try:
+        yield
+    finally:
+        flusher.cancel()
+        await asyncio.to_thread(_flush_notes)
+
+
+mcp = FastMCP("Multiple MCP tools including RAG in single MCP server", lifespan=_lifespan)
+
+BRAVE_NEWS_URL = "https://api.search.brave.com/res/v1/news/search"
+WEATHER_URL = "http://api.weatherapi.com/v1/current.json"
+
+BRAVE_HEADERS = {
+    "Accept": "application/json",
+    "X-Subscription-Token": brave_api_key,
+}
+
+# Shared client so repeated tool calls reuse pooled keep-alive connections
+# instead of paying DNS + TLS setup on every request.
+_http = httpx.AsyncClient(
+    http2=True,
+    timeout=10.0,
+    default_encoding="utf-8",
+    limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+)
+
+# Cap on concurrent outbound requests, kept per host so a burst of Brave
+# searches cannot starve weather lookups (and vice versa).
+OUT_CONCURRENCY = int(os.getenv("OUT_CONCURRENCY", "8"))
+
+_out_sems: dict[str, asyncio.Semaphore] = {}
+
+
+async def _get(url: str, **kwargs) -> httpx.Response:
+    host = httpx.URL(url).host
+    sem = _out_sems.get(host)
+    if sem is None:
+        sem = _out_sems[host] = asyncio.Semaphore(OUT_CONCURRENCY)
+    async with sem:
+        return await _http.get(url, **kwargs)
+
+
+def _json_text(response: httpx.Response) -> str:
+    """
+    Parse a JSON response with orjson and serialize it compactly once, so the
+    note and the tool result share the same string. Non-JSON bodies (such as
+    error pages) are passed through unchanged.
+    """
+    try:
+        return orjson.dumps(orjson.loads(response.content)).decode()
+    except orjson.JSONDecodeError:
+        return response.text
 
 NOTES_FILE = os.path.join(os.path.dirname(__file__), "notes.txt")
 
@@ -26,6 +109,98 @@ def ensure_file():
             f.write("Notes:\n")
 
 
+# Notes are buffered in memory and appended to NOTES_FILE in batches, either
+# every NOTE_FLUSH_INTERVAL seconds by the background flusher or as soon as
+# NOTE_FLUSH_THRESHOLD notes are pending.
+NOTE_FLUSH_INTERVAL = 0.05
+NOTE_FLUSH_THRESHOLD = 64
+
+_note_buffer: deque[str] = deque()
+_note_lock = threading.RLock()
+
+
+# NOTES_FILE is created once at import and stays open in append mode for the
+# life of the process, so a flush is a single write instead of an
+# open/write/close round-trip and the tools never check for the file.
+ensure_file()
+_notes_fd = open(NOTES_FILE, "ab", buffering=1 << 16)
+
+
+def _reopen_notes() -> None:
+    """
+    Recreate NOTES_FILE and reopen the append descriptor after the file was
+    deleted while the server was running.
+    """
+    global _notes_fd
+    with _note_lock:
+        _notes_fd.close()
+        ensure_file()
+        _notes_fd = open(NOTES_FILE, "ab", buffering=1 << 16)
+
+
+def _direct_append(lines: list[str]) -> None:
+    if os.fstat(_notes_fd.fileno()).st_nlink == 0:
+        _reopen_notes()
+    _notes_fd.write("".join(lines).encode())
+    _notes_fd.flush()
+
+
+def _flush_notes() -> None:
+    """
+    Drain the note buffer and write all pending notes with a single append.
+
+    Notes are not critical, so a failed write is logged rather than raised and
+    the batch is put back at the front of the buffer for the next flush.
+    """
+    with _note_lock:
+        lines = []
+        while _note_buffer:
+            lines.append(_note_buffer.popleft())
+        if lines:
+            try:
+                _direct_append(lines)
+            except OSError:
+                _note_buffer.extendleft(reversed(lines))
+                logger.exception("Failed to write %d notes to %s", len(lines), NOTES_FILE)
+
+
+async def _flush_loop() -> None:
+    while True:
+        await asyncio.sleep(NOTE_FLUSH_INTERVAL)
+        if _note_buffer:
+            await asyncio.to_thread(_flush_notes)
+
+
+async def _add_note_async(message: str) -> None:
+    """
+    Queue a note from async code; a full buffer is flushed in a worker thread
+    so the event loop never blocks on the file write.
+    """
+    _note_buffer.append(message + "\n")
+    if len(_note_buffer) >= NOTE_FLUSH_THRESHOLD:
+        await asyncio.to_thread(_flush_notes)
+
+
+def _close_notes() -> None:
+    _flush_notes()
+    _notes_fd.close()
+
+
+atexit.register(_close_notes)
+
+
+def _on_sigterm(signum, frame) -> None:
+    # atexit does not run on SIGTERM, so write pending notes before handing
+    # the signal on to whatever handler was installed before this one.
+    _flush_notes()
+    signal.signal(signum, _previous_sigterm or signal.SIG_DFL)
+    signal.raise_signal(signum)
+
+
+# Signal handlers can only be installed from the main thread.
+if threading.current_thread() is threading.main_thread():
+    _previous_sigterm = signal.signal(signal.SIGTERM, _on_sigterm)
+
 
 @mcp.tool()
 def add_note(message:str) -> str:
@@ -38,9 +213,9 @@ def add_note(message:str) -> str:
     Returns:
         str: Confirmation message indicating the note has been added.
     """
-    ensure_file()
-    with open(NOTES_FILE, "a") as f:
-        f.write(message + "\n")
+    _note_buffer.append(message + "\n")
+    if len(_note_buffer) >= NOTE_FLUSH_THRESHOLD:
+        _flush_notes()
     return "Note added successfully"
 
 
@@ -50,11 +225,6 @@ async def brave_search_results(news:str) -> str:
     Fetch search results from Brave Search engine.
     """
 
-    headers = {
-        "Accept": "application/json",
-        "X-Subscription-Token": brave_api_key,
-    }
-
     params = {
         "q": news,
         "count": 10,
@@ -63,10 +233,10 @@ async def brave_search_results(news:str) -> str:
         "search_lang": "en",
     }
 
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"https://api.search.brave.com/res/v1/news/search", headers=headers, params=params)
-        add_note(response.text)
-        return response.text
+    response = await _get(BRAVE_NEWS_URL, headers=BRAVE_HEADERS, params=params)
+    text = _json_text(response)
+    await _add_note_async(text)
+    return text
     
 
 @mcp.tool()
@@ -75,13 +245,61 @@ async def fetch_weather(city:str) -> str:
     Fetch weather information for a given city.
     """
 
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"http://api.weatherapi.com/v1/current.json?key={weather_api_key}&q={city}&aqi=no")
-        add_note(response.text)
-        return response.text
+    params = {
+        "key": weather_api_key,
+        "q": city,
+        "aqi": "no",
+    }
+
+    response = await _get(WEATHER_URL, params=params)
+    text = _json_text(response)
+    await _add_note_async(text)
+    return text
     
 
 
+# Whole-file reads are served from a snapshot that is refreshed only when the
+# file's mtime or size changes; the latest note is found by reading just the
+# tail of the file.
+NOTES_TAIL_BYTES = 64 * 1024
+
+_notes_cache: Optional[tuple[tuple[int, int], str]] = None
+
+
+def _read_all_notes() -> str:
+    global _notes_cache
+    try:
+        st = os.stat(NOTES_FILE)
+    except FileNotFoundError:
+        _reopen_notes()
+        st = os.stat(NOTES_FILE)
+    stamp = (st.st_mtime_ns, st.st_size)
+    if _notes_cache is None or _notes_cache[0] != stamp:
+        with open(NOTES_FILE, "r") as f:
+            _notes_cache = (stamp, f.read().strip())
+    return _notes_cache[1]
+
+
+def _read_last_note() -> Optional[str]:
+    try:
+        f = open(NOTES_FILE, "rb")
+    except FileNotFoundError:
+        _reopen_notes()
+        f = open(NOTES_FILE, "rb")
+    with f:
+        size = f.seek(0, os.SEEK_END)
+        window = NOTES_TAIL_BYTES
+        while True:
+            start = max(0, size - window)
+            f.seek(start)
+            lines = f.read().splitlines()
+            # Unless the read began at the start of the file its first line
+            # may be partial, so grow the window until the last line is whole.
+            if start == 0 or len(lines) > 1:
+                return lines[-1].decode() if lines else None
+            window *= 2
+
+
 @mcp.tool()
 def read_notes() -> str:
     """
@@ -91,9 +309,8 @@ def read_notes() -> str:
         str: All notes as a single string separated by line breaks.
             If no notes exist, return an empty string.
     """
-    ensure_file()
-    with open(NOTES_FILE, "r") as f:
-        content = f.read().strip()
+    _flush_notes()
+    content = _read_all_notes()
     return content or "No notes found."
 
 @mcp.resource("notes://latest")
@@ -104,10 +321,9 @@ def get_latest_notes() -> str:
     Returns:
         str: The last note entry. If no notes exist, return an empty string.
     """
-    ensure_file()
-    with open(NOTES_FILE, "r") as f:
-        notes = f.readlines()
-    return notes[-1].strip() if notes else "No notes found."
+    _flush_notes()
+    note = _read_last_note()
+    return note.strip() if note is not None else "No notes found."
 
 
 @mcp.prompt()
@@ -119,9 +335,8 @@ def note_summary_prompt() -> str:
         str: A prompt string that includes all notes and asks for a summary.
         If no notes exist, a message indicating that no notes are available.
     """
-    ensure_file()
-    with open(NOTES_FILE, "r") as f:
-        content = f.read().strip()
+    _flush_notes()
+    content = _read_all_notes()
     if not content:
         return "No notes found."
     return f"Summarize the following notes:\n{content}"
@@ -130,6 +345,291 @@ def note_summary_prompt() -> str:
 
 # mcp = FastMCP("mcp-rag", port=8559)
 client = GroundX(api_key=groundx_api_key)
+_openai_client: Optional[openai.AsyncOpenAI] = None
+
+
+def _get_openai_client() -> openai.AsyncOpenAI:
+    """
+    Build the shared OpenAI client on first use, so the server and its non-RAG
+    tools start without an OpenAI key.
+    """
+    global _openai_client
+    if _openai_client is None:
+        _openai_client = openai.AsyncOpenAI(api_key=openai_api_key)
+    return _openai_client
+
+
+class _TTLCache:
+    """
+    In-memory LRU cache whose entries expire `ttl` seconds after being stored.
+    """
+
+    def __init__(self, ttl: float = 3600, max_size: int = 500):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._cache: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        # Bumped on every insert or removal so callers can tell when an index
+        # derived from the cached values is out of date.
+        self.version = 0
+
+    @staticmethod
+    def key(*parts: Any) -> str:
+        raw = "\x00".join(str(part).strip().lower() for part in parts)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            item = self._cache.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._cache[key]
+                self.version += 1
+                self.misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._cache[key] = (time.monotonic() + self.ttl, value)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+            self.version += 1
+
+    def snapshot(self) -> tuple[list[Any], float]:
+        """
+        Return the unexpired values and the time at which the first of them expires.
+        """
+        with self._lock:
+            now = time.monotonic()
+            live = [(expires_at, value) for expires_at, value in self._cache.values() if expires_at >= now]
+        return [value for _, value in live], min((expires_at for expires_at, _ in live), default=math.inf)
+
+
+# OpenAI completions are persisted on disk, keyed by the full prompt, so
+# repeats survive restarts.
+LLM_CACHE_DIR = os.path.join(os.path.dirname(__file__), ".cache", "openai")
+LLM_CACHE_TTL = 24 * 60 * 60
+
+_llm_cache = diskcache.Cache(LLM_CACHE_DIR, size_limit=2 << 30)
+
+
+def _llm_cache_key(model: str, context: str, query: str) -> str:
+    digest = _SYSTEM_PREFIX_HASH.copy()
+    digest.update("\x00".join((model, context, query)).encode())
+    return digest.hexdigest()
+
+
+# GroundX retrievals are reused for a short while per (bucket, query, n).
+# Only retrieved chunks are cached here, never answers, so a repeat can at
+# worst see a corpus that is SEARCH_CACHE_TTL seconds old.
+SEARCH_CACHE_TTL = 600
+
+_search_cache = _TTLCache(ttl=SEARCH_CACHE_TTL, max_size=1024)
+_embedding_cache = _TTLCache(max_size=2000)
+
+
+def _fetch_search(groundx: GroundX, bucket_id: Any, query: str, n: Optional[int] = None):
+    kwargs = {"n": n} if n is not None else {}
+    return groundx.search.content(id=bucket_id, query=query, **kwargs).search
+
+
+def _search_content(groundx: GroundX, bucket_id: Any, query: str, n: Optional[int] = None):
+    key = _TTLCache.key(bucket_id, query, n)
+    results = _search_cache.get(key)
+    if results is None:
+        results = _fetch_search(groundx, bucket_id, query, n)
+        _search_cache.set(key, results)
+    if CACHE_DEBUG:
+        logger.info("GroundX search cache: %d hits, %d misses", _search_cache.hits, _search_cache.misses)
+    return results
+
+
+# Identical retrievals that are already running are shared: later callers
+# await the first caller's task instead of issuing a duplicate request.
+_inflight: dict[str, asyncio.Task] = {}
+
+
+async def _search(groundx: GroundX, bucket_id: Any, query: str, n: Optional[int] = None):
+    key = _TTLCache.key(bucket_id, query, n)
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(asyncio.to_thread(_search_content, groundx, bucket_id, query, n))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # Shielded so one caller being cancelled does not cancel the shared search
+    return await asyncio.shield(task)
+
+
+# Answers are only reused when all GroundedCache admission gates pass against
+# the evidence retrieved for the new query:
+#   G1 - the queries are semantically close (embedding cosine similarity)
+#   G2 - the retrieved chunk sets largely overlap (Jaccard)
+#   G3 - the chunks both retrievals share have not changed
+#   G4 - the answer tokens grounded in the old evidence are still covered
+_answer_cache = _TTLCache()
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+GATE_QUERY_SIMILARITY = 0.92
+GATE_CHUNK_JACCARD = 0.8
+
+
+class _Evidence(NamedTuple):
+    chunk_versions: dict[str, str]
+    tokens: frozenset[str]
+
+
+class _AnswerEntry(NamedTuple):
+    bucket_id: Any
+    model: str
+    query_emb: np.ndarray
+    evidence: _Evidence
+    answer_tokens: frozenset[str]
+    answer: str
+
+
+def _tokens(text: Optional[str]) -> frozenset[str]:
+    return frozenset(re.findall(r"\w+", (text or "").lower()))
+
+
+def _evidence(results) -> _Evidence:
+    # GroundX does not expose chunk versions, so a hash of the chunk text
+    # stands in for one.
+    chunk_versions = {
+        f"{item.document_id}:{item.chunk_id}": hashlib.sha256((item.text or "").encode()).hexdigest()
+        for item in results.results or []
+    }
+    return _Evidence(chunk_versions, _tokens(results.text))
+
+
+def _quantize(embedding: list[float]) -> np.ndarray:
+    """
+    Quantize an embedding to int8 with a per-vector scale. The scale is not
+    kept: cosine similarity is invariant to it.
+    """
+    vector = np.asarray(embedding, dtype=np.float32)
+    scale = float(np.abs(vector).max()) / 127 or 1.0
+    return np.round(vector / scale).astype(np.int8)
+
+
+async def _embed_query(llm: openai.AsyncOpenAI, query: str) -> np.ndarray:
+    key = _TTLCache.key(EMBEDDING_MODEL, query)
+    embedding = _embedding_cache.get(key)
+    if embedding is None:
+        response = await llm.embeddings.create(model=EMBEDDING_MODEL, input=query)
+        embedding = _quantize(response.data[0].embedding)
+        _embedding_cache.set(key, embedding)
+    return embedding
+
+
+async def _try_embed_query(llm: openai.AsyncOpenAI, query: str) -> Optional[np.ndarray]:
+    """
+    The query embedding only feeds the answer cache, so if it fails the query
+    is answered without that cache instead of failing.
+    """
+    try:
+        return await _embed_query(llm, query)
+    except Exception:
+        logger.warning("Query embedding failed, skipping the answer cache", exc_info=True)
+        return None
+
+
+# Stacked int8 query embeddings of the cached answers and their norms, rebuilt
+# only when the answer cache changes or one of its entries expires.
+_answer_index: Optional[tuple[int, float, list[_AnswerEntry], np.ndarray, np.ndarray]] = None
+
+# Rows of the int8 index promoted to int32 at a time during a lookup, which
+# bounds the temporary copy instead of promoting the whole matrix at once.
+ANSWER_INDEX_BLOCK = 1024
+
+
+def _load_answer_index() -> tuple[list[_AnswerEntry], np.ndarray, np.ndarray]:
+    global _answer_index
+    if (
+        _answer_index is None
+        or _answer_index[0] != _answer_cache.version
+        or _answer_index[1] <= time.monotonic()
+    ):
+        version = _answer_cache.version
+        entries, next_expiry = _answer_cache.snapshot()
+        if entries:
+            matrix = np.stack([entry.query_emb for entry in entries])
+            norms = np.sqrt(np.einsum("ij,ij->i", matrix, matrix, dtype=np.int64)).astype(np.float32)
+            norms[norms == 0] = np.inf
+        else:
+            matrix = np.empty((0, 0), dtype=np.int8)
+            norms = np.empty(0, dtype=np.float32)
+        _answer_index = (version, next_expiry, entries, matrix, norms)
+    return _answer_index[2:]
+
+
+def _passes_gates(entry: _AnswerEntry, evidence: _Evidence) -> bool:
+    old_chunks = entry.evidence.chunk_versions
+    new_chunks = evidence.chunk_versions
+    # Without retrieved chunks there is no evidence to check the answer
+    # against, and G1 alone is not enough to reuse it.
+    if not old_chunks or not new_chunks:
+        return False
+
+    shared = old_chunks.keys() & new_chunks.keys()
+    union = old_chunks.keys() | new_chunks.keys()
+    if len(shared) / len(union) < GATE_CHUNK_JACCARD:
+        return False
+
+    if any(old_chunks[chunk] != new_chunks[chunk] for chunk in shared):
+        return False
+
+    return entry.answer_tokens <= evidence.tokens
+
+
+def _grounded_lookup(query_emb: np.ndarray, evidence: _Evidence, bucket_id: Any, model: str) -> Optional[str]:
+    """
+    Return the cached answer of the most similar entry that passes every
+    admission gate, or None if the answer has to be regenerated.
+    """
+    entries, matrix, norms = _load_answer_index()
+    query = query_emb.astype(np.int32)
+    query_norm = float(np.sqrt(query @ query))
+    if not entries or not query_norm:
+        return None
+
+    # G1 for every cached entry: int32 matrix-vector products over the int8
+    # index, one block of rows at a time
+    dots = np.concatenate([
+        matrix[start:start + ANSWER_INDEX_BLOCK].astype(np.int32) @ query
+        for start in range(0, len(matrix), ANSWER_INDEX_BLOCK)
+    ])
+    similarities = dots / (norms * query_norm)
+    for i in np.argsort(similarities)[::-1]:
+        if similarities[i] < GATE_QUERY_SIMILARITY:
+            break
+        entry = entries[i]
+        if entry.bucket_id == bucket_id and entry.model == model and _passes_gates(entry, evidence):
+            return entry.answer
+    return None
+
+
+def _grounded_admit(query: str, query_emb: np.ndarray, evidence: _Evidence, bucket_id: Any, model: str, answer: str) -> None:
+    if not evidence.chunk_versions:
+        return
+
+    entry = _AnswerEntry(
+        bucket_id=bucket_id,
+        model=model,
+        query_emb=query_emb,
+        evidence=evidence,
+        answer_tokens=_tokens(answer) & evidence.tokens,
+        answer=answer,
+    )
+    _answer_cache.set(_TTLCache.key(query, bucket_id, model), entry)
 
 class SearchResponse(BaseModel):
     query: str
@@ -137,34 +637,21 @@ class SearchResponse(BaseModel):
     result: str
 
 class SearchConfig(BaseModel):
-    openai_api_key: str = Field(default_factory=lambda: os.getenv("OPENAI_API_KEY"))
-    groundx_api_key: str = Field(default_factory=lambda: os.getenv("GROUNDX_API_KEY"))
-    completion_model: str = "gpt-4o"
-    bucket_id: int = Field(default_factory=lambda: os.getenv("BUCKET_ID"))
-
-
-@mcp.tool()
-def process_search_query(query: str, config: Optional[SearchConfig] = None) -> SearchResponse:
-    """
-    Process a search query using GroundX and OpenAI.
+    model_config = ConfigDict(frozen=True)
 
-    Args:
-        query: The search query string
-        config: Optional SearchConfig object for customization
+    # The keys use factories over the values read at import so they are not
+    # published as defaults in the tool's JSON schema.
+    openai_api_key: str = Field(default_factory=lambda: openai_api_key)
+    groundx_api_key: str = Field(default_factory=lambda: groundx_api_key)
+    completion_model: str = COMPLETION_MODEL
+    bucket_id: Optional[int] = BUCKET_ID
 
-    Returns:
-        SearchResponse object containing the query, score, and result
-    """
 
-    if config is None:
-        config = SearchConfig()
+_DEFAULT_CONFIG = SearchConfig()
 
-    # Initialize clients
-    client = GroundX(api_key=config.groundx_api_key)
-    openai.api_key = config.openai_api_key
 
-    # System instructions for the AI
-    instruction = """`You are a highly knowledgeable assistant. Your primary role is to assist developers by answering questions related to documents they have uploaded and that have been processed by the GroundX proprietary ingestion pipeline. This pipeline creates semantic objects and is known for delivering the highest accuracy in RAG retrievals on the market.
+# System instructions for the AI
+SYSTEM_INSTRUCTION = """`You are a highly knowledgeable assistant. Your primary role is to assist developers by answering questions related to documents they have uploaded and that have been processed by the GroundX proprietary ingestion pipeline. This pipeline creates semantic objects and is known for delivering the highest accuracy in RAG retrievals on the market.
 
         Key Responsibilities:
             1.	Document Verification and Summary:
@@ -194,37 +681,128 @@ def process_search_query(query: str, config: Optional[SearchConfig] = None) -> S
 
             2.	Incorrect or Ambiguous Filenames: If the developer refers to a document with a filename that is slightly incorrect or ambiguous, attempt to match it with the closest available document and confirm with the developer.
 
-            3.	General Questions: When asked general questions, please rely on your general knowledge of the world.`"""
+            3.	General Questions: When asked general questions, please rely on your general knowledge of the world.`""".strip()
 
-    content_response = client.search.content(
-        id = config.bucket_id,
-        query = query
-    )
+# The system message is the constant instruction followed by the retrieved
+# context. Keeping the instruction as a fixed leading prefix lets the provider
+# reuse its prompt cache across calls, and its hash is computed once for the
+# completion cache key.
+SYSTEM_PREFIX = SYSTEM_INSTRUCTION + "\n===\n"
+SYSTEM_SUFFIX = "\n===\n"
+_SYSTEM_PREFIX_HASH = hashlib.sha256(SYSTEM_PREFIX.encode())
 
-    results = content_response.search
-
-    completion = openai.chat.completions.create(
-        model = config.completion_model,
-        messages= [
-            {
-                "role" : "system",
-                "content" : f"{instruction}\n===\n{results.text}\n===\n"
-            },
-            {
-                "role" : "user" ,
-                "content" : query
-            },
-        ],
-    )
+# Streamed completions send the partial answer to the client as a progress
+# message at most this often, so a long answer does not turn into one
+# notification per token.
+PROGRESS_INTERVAL = 0.1
 
-    return SearchResponse(
-        query = query,
-        score = results.score,
-        result = completion.choices[0].message.content
-    )
 
 @mcp.tool()
-def search_doc_for_rag_context(query: str) -> str:
+async def process_search_query(query: str, config: Optional[SearchConfig] = None, ctx: Context = None) -> SearchResponse:
+    """
+    Process a search query using GroundX and OpenAI.
+
+    Args:
+        query: The search query string
+        config: Optional SearchConfig object for customization
+        ctx: MCP request context, injected by FastMCP; the partial answer
+            is reported on it as progress while the completion streams in
+
+    Returns:
+        SearchResponse object containing the query, score, and result
+    """
+
+    if config is None:
+        config = _DEFAULT_CONFIG
+
+    # Reuse the shared clients unless the config asks for different keys. The
+    # per-call ones are closed when the query is done so their connection
+    # pools do not leak; GroundX has no close() of its own, so it gets an
+    # httpx client we can close.
+    groundx_http = None
+    if config.groundx_api_key == groundx_api_key:
+        groundx = client
+    else:
+        groundx_http = httpx.Client()
+        groundx = GroundX(api_key=config.groundx_api_key, httpx_client=groundx_http)
+    if config.openai_api_key == openai_api_key:
+        llm = _get_openai_client()
+    else:
+        llm = openai.AsyncOpenAI(api_key=config.openai_api_key)
+
+    try:
+        # The search, answer and completion caches and the in-flight map are
+        # shared by every caller, so they are only used with the server's own
+        # keys. Other keys always fetch and generate with those keys.
+        use_cache = groundx is client and config.openai_api_key == openai_api_key
+
+        if use_cache:
+            # Retrieval and the query embedding are independent, so overlap them
+            results, query_emb = await asyncio.gather(
+                _search(groundx, config.bucket_id, query),
+                _try_embed_query(llm, query),
+            )
+
+            evidence = _evidence(results)
+            if query_emb is not None:
+                cached = _grounded_lookup(query_emb, evidence, config.bucket_id, config.completion_model)
+                if cached is not None:
+                    return SearchResponse(
+                        query = query,
+                        score = results.score,
+                        result = cached
+                    )
+
+            llm_key = _llm_cache_key(config.completion_model, results.text or "", query)
+            answer = await asyncio.to_thread(_llm_cache.get, llm_key)
+        else:
+            results = await asyncio.to_thread(_fetch_search, groundx, config.bucket_id, query)
+            answer = None
+
+        if answer is None:
+            stream = await llm.chat.completions.create(
+                model = config.completion_model,
+                stream = True,
+                messages= [
+                    {
+                        "role" : "system",
+                        "content" : SYSTEM_PREFIX + (results.text or "") + SYSTEM_SUFFIX
+                    },
+                    {
+                        "role" : "user" ,
+                        "content" : query
+                    },
+                ],
+            )
+            parts = []
+            last_progress = time.monotonic()
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                    now = time.monotonic()
+                    if ctx is not None and now - last_progress >= PROGRESS_INTERVAL:
+                        last_progress = now
+                        await ctx.report_progress(len(parts), message="".join(parts))
+            answer = "".join(parts)
+            if use_cache:
+                await asyncio.to_thread(_llm_cache.set, llm_key, answer, expire=LLM_CACHE_TTL)
+
+        if use_cache and query_emb is not None:
+            _grounded_admit(query, query_emb, evidence, config.bucket_id, config.completion_model, answer)
+
+        return SearchResponse(
+            query = query,
+            score = results.score,
+            result = answer
+        )
+    finally:
+        if config.openai_api_key != openai_api_key:
+            await llm.close()
+        if groundx_http is not None:
+            groundx_http.close()
+
+@mcp.tool()
+async def search_doc_for_rag_context(query: str) -> str:
     """
     Searches and retrieves relevant context from a knowledge base,
     based on the user's query.
@@ -236,49 +814,91 @@ def search_doc_for_rag_context(query: str) -> str:
         str: Relevant text content that can be used by the LLM to answer the query.
     """
 
-    response = client.search.content(
-        id = os.getenv("BUCKET_ID"),
-        query = query,
-        n = 5,
-    )
+    results = await _search(client, BUCKET_ID, query, n=5)
+    return results.text
+
 
-    return response.search.text
+# File extensions we ingest, mapped to their GroundX file_type. Markdown has
+# no type of its own and is uploaded as plain text.
+INGEST_FILE_TYPES = {
+    ".pdf": "pdf",
+    ".txt": "txt",
+    ".md": "txt",
+    ".docx": "docx",
+    ".pptx": "pptx",
+    ".xlsx": "xlsx",
+    ".csv": "csv",
+    ".tsv": "tsv",
+    ".json": "json",
+    ".png": "png",
+    ".jpg": "jpg",
+    ".jpeg": "jpg",
+}
+
+
+def _sniff_type(local_file_path: str) -> str:
+    extension = os.path.splitext(local_file_path)[1].lower()
+    if extension not in INGEST_FILE_TYPES:
+        raise ValueError(f"Unsupported file type for ingestion: {local_file_path}")
+    return INGEST_FILE_TYPES[extension]
 
 
 @mcp.tool()
-def ingest_documents(local_file_path: str) -> str:
+async def ingest_documents(local_file_paths: list[str]) -> str:
     """
-    Ingest documents from a local file into the knoledge base.
+    Ingest documents from local files into the knoledge base in a single request.
 
     Args:
-        local_file_path: the path to the local file containing the documents to ingest.
+        local_file_paths: the paths to the local files containing the documents to ingest.
     
     Returns:
         str: A message indicating the documents have been ingested.
 
     """
-    file_name = os.path.basename(local_file_path)
-    client.ingest(
-        documents=[
-            Document(
-                bucket_id=os.getenv("BUCKET_ID"),
-                file_name=file_name,
-                file_path=local_file_path,
-                file_type="pdf",
-                search_data=dict(
-                    key = "value",
-                ),
-            )
-        ]
-    )
-
-    return f""" Ingested {file_name} into the knowledge base.
+    if not local_file_paths:
+        raise ValueError("No files given for ingestion")
+    documents = [
+        Document(
+            bucket_id=BUCKET_ID,
+            file_name=os.path.basename(local_file_path),
+            file_path=local_file_path,
+            file_type=_sniff_type(local_file_path),
+            search_data=dict(
+                key = "value",
+            ),
+        )
+        for local_file_path in local_file_paths
+    ]
+    await asyncio.to_thread(client.ingest, documents=documents)
+
+    file_names = ", ".join(document.file_name for document in documents)
+    return f""" Ingested {file_names} into the knowledge base.
                 It should be available in a few minutes. """
 
+
+@mcp.tool()
+async def ingest_document(local_file_path: str) -> str:
+    """
+    Ingest a single local file into the knoledge base.
+
+    Args:
+        local_file_path: the path to the local file containing the documents to ingest.
+
+    Returns:
+        str: A message indicating the document has been ingested.
+    """
+    return await ingest_documents([local_file_path])
+
 async def main():
-    await mcp.run_stdio_async()
+    try:
+        await mcp.run_stdio_async()
+    finally:
+        await _http.aclose()
+        if _openai_client is not None:
+            await _openai_client.close()
+        _close_notes()
     # await rag_mcp.run_stdio_async()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main(), loop_factory=uvloop.new_event_loop if uvloop else None)
\ No newline at end of file
@@ -0,0 +1,363 @@
+import asyncio
+import math
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import main
+
+
+def search_results(texts, text="paris is the capital of france"):
+    items = [
+        SimpleNamespace(document_id="doc", chunk_id=str(i), text=chunk)
+        for i, chunk in enumerate(texts)
+    ]
+    return SimpleNamespace(results=items, text=text, score=1.0)
+
+
+@pytest.fixture
+def answer_cache(monkeypatch):
+    monkeypatch.setattr(main, "_answer_cache", main._TTLCache())
+    monkeypatch.setattr(main, "_answer_index", None)
+
+
+@pytest.fixture
+def embedding():
+    return main._quantize(np.linspace(-1, 1, 16))
+
+
+CHUNKS = [f"chunk {i}" for i in range(5)]
+
+
+def test_grounded_cache_hit_with_same_evidence(answer_cache, embedding):
+    evidence = main._evidence(search_results(CHUNKS))
+    main._grounded_admit("q", embedding, evidence, 1, "gpt-4o", "The capital is Paris")
+
+    assert main._grounded_lookup(embedding, evidence, 1, "gpt-4o") == "The capital is Paris"
+
+
+def test_grounded_cache_miss_for_dissimilar_query(answer_cache, embedding):
+    evidence = main._evidence(search_results(CHUNKS))
+    main._grounded_admit("q", embedding, evidence, 1, "gpt-4o", "The capital is Paris")
+
+    other = main._quantize(np.linspace(1, -1, 16))
+    assert main._grounded_lookup(other, evidence, 1, "gpt-4o") is None
+
+
+def test_grounded_cache_miss_for_other_bucket_or_model(answer_cache, embedding):
+    evidence = main._evidence(search_results(CHUNKS))
+    main._grounded_admit("q", embedding, evidence, 1, "gpt-4o", "The capital is Paris")
+
+    assert main._grounded_lookup(embedding, evidence, 2, "gpt-4o") is None
+    assert main._grounded_lookup(embedding, evidence, 1, "gpt-4o-mini") is None
+
+
+def test_grounded_cache_miss_when_chunk_overlap_drops(answer_cache, embedding):
+    main._grounded_admit("q", embedding, main._evidence(search_results(CHUNKS)), 1, "gpt-4o", "Paris")
+
+    evidence = main._evidence(search_results(CHUNKS[:3]))
+    assert main._grounded_lookup(embedding, evidence, 1, "gpt-4o") is None
+
+
+def test_grounded_cache_miss_when_shared_chunk_changes(answer_cache, embedding):
+    main._grounded_admit("q", embedding, main._evidence(search_results(CHUNKS)), 1, "gpt-4o", "Paris")
+
+    evidence = main._evidence(search_results(CHUNKS[:-1] + ["chunk 4 edited"]))
+    assert main._grounded_lookup(embedding, evidence, 1, "gpt-4o") is None
+
+
+def test_grounded_cache_miss_when_answer_no_longer_covered(answer_cache, embedding):
+    main._grounded_admit("q", embedding, main._evidence(search_results(CHUNKS)), 1, "gpt-4o", "Paris")
+
+    evidence = main._evidence(search_results(CHUNKS, text="lyon is the capital of france"))
+    assert main._grounded_lookup(embedding, evidence, 1, "gpt-4o") is None
+
+
+def test_grounded_cache_does_not_admit_answers_without_evidence(answer_cache, embedding):
+    evidence = main._evidence(search_results([], text=""))
+    main._grounded_admit("q", embedding, evidence, 1, "gpt-4o", "General knowledge answer")
+
+    assert main._answer_cache.snapshot()[0] == []
+    assert main._grounded_lookup(embedding, evidence, 1, "gpt-4o") is None
+
+
+def test_grounded_cache_miss_when_new_retrieval_is_empty(answer_cache, embedding):
+    main._grounded_admit("q", embedding, main._evidence(search_results(CHUNKS)), 1, "gpt-4o", "Paris")
+
+    evidence = main._evidence(search_results([], text=""))
+    assert main._grounded_lookup(embedding, evidence, 1, "gpt-4o") is None
+
+
+def test_answer_index_stays_int8(answer_cache, embedding):
+    evidence = main._evidence(search_results(CHUNKS))
+    main._grounded_admit("q", embedding, evidence, 1, "gpt-4o", "Paris")
+
+    _, matrix, norms = main._load_answer_index()
+    assert matrix.dtype == np.int8
+    assert np.allclose(norms, np.linalg.norm(matrix.astype(np.float32), axis=1))
+
+    main._grounded_lookup(embedding, evidence, 1, "gpt-4o")
+    assert main._load_answer_index()[1] is matrix
+
+
+def test_grounded_lookup_across_index_blocks(answer_cache, embedding, monkeypatch):
+    monkeypatch.setattr(main, "ANSWER_INDEX_BLOCK", 2)
+    evidence = main._evidence(search_results(CHUNKS))
+    for i in range(4):
+        other = main._quantize(np.roll(np.linspace(-1, 1, 16), i + 4))
+        main._grounded_admit(f"q{i}", other, evidence, 1, "gpt-4o", f"other {i}")
+    main._grounded_admit("q", embedding, evidence, 1, "gpt-4o", "Paris")
+
+    assert main._grounded_lookup(embedding, evidence, 1, "gpt-4o") == "Paris"
+
+
+@pytest.fixture
+def notes_file(tmp_path, monkeypatch):
+    path = tmp_path / "notes.txt"
+    monkeypatch.setattr(main, "NOTES_FILE", str(path))
+    monkeypatch.setattr(main, "_notes_cache", None)
+    return path
+
+
+def test_read_last_note_empty_file(notes_file):
+    notes_file.write_bytes(b"")
+    assert main._read_last_note() is None
+
+
+def test_read_last_note_without_trailing_newline(notes_file):
+    notes_file.write_bytes(b"Notes:\nfirst\nlast")
+    assert main._read_last_note() == "last"
+
+
+def test_read_last_note_longer_than_tail_window(notes_file, monkeypatch):
+    monkeypatch.setattr(main, "NOTES_TAIL_BYTES", 16)
+    long_note = "x" * 100
+    notes_file.write_text(f"Notes:\nfirst\n{long_note}\n")
+    assert main._read_last_note() == long_note
+
+
+def test_read_last_note_only_line_longer_than_tail_window(notes_file, monkeypatch):
+    monkeypatch.setattr(main, "NOTES_TAIL_BYTES", 16)
+    notes_file.write_text("y" * 100)
+    assert main._read_last_note() == "y" * 100
+
+
+def test_read_all_notes_refreshes_after_append(notes_file):
+    notes_file.write_text("Notes:\nfirst\n")
+    assert main._read_all_notes() == "Notes:\nfirst"
+
+    with open(notes_file, "a") as f:
+        f.write("second\n")
+    assert main._read_all_notes() == "Notes:\nfirst\nsecond"
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = main._TTLCache(max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+
+
+def test_ttl_cache_expires_entries(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    cache = main._TTLCache(ttl=10)
+    cache.set("a", 1)
+
+    now[0] = 109.0
+    assert cache.get("a") == 1
+    now[0] = 111.0
+    assert cache.get("a") is None
+    assert cache.snapshot() == ([], math.inf)
+
+
+def test_ttl_cache_key_normalises_query():
+    assert main._TTLCache.key(1, "  Paris ") == main._TTLCache.key(1, "paris")
+    assert main._TTLCache.key(1, "paris") != main._TTLCache.key(2, "paris")
+
+
+class SlowGroundX:
+    def __init__(self):
+        self.calls = 0
+        self.search = SimpleNamespace(content=self.content)
+
+    def content(self, id, query, **kwargs):
+        self.calls += 1
+        time.sleep(0.05)
+        if query == "fail":
+            raise RuntimeError("search failed")
+        return SimpleNamespace(search=search_results(CHUNKS, text=query))
+
+
+@pytest.fixture
+def search_state(monkeypatch):
+    monkeypatch.setattr(main, "_search_cache", main._TTLCache())
+    monkeypatch.setattr(main, "_inflight", {})
+
+
+def test_search_shares_in_flight_requests(search_state):
+    groundx = SlowGroundX()
+
+    async def run():
+        return await asyncio.gather(
+            *(main._search(groundx, 1, "paris") for _ in range(5)),
+            main._search(groundx, 1, "lyon"),
+        )
+
+    results = asyncio.run(run())
+    assert [r.text for r in results] == ["paris"] * 5 + ["lyon"]
+    assert groundx.calls == 2
+    assert main._inflight == {}
+
+
+def test_search_propagates_errors_to_every_waiter(search_state):
+    groundx = SlowGroundX()
+
+    async def run():
+        return await asyncio.gather(
+            *(main._search(groundx, 1, "fail") for _ in range(3)),
+            return_exceptions=True,
+        )
+
+    results = asyncio.run(run())
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert groundx.calls == 1
+    assert main._inflight == {}
+
+
+class FakeOpenAI:
+    def __init__(self, chunks=("Paris",)):
+        self.chunks = chunks
+        self.requests = []
+        self.embeddings = SimpleNamespace(create=self.embed)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.complete))
+
+    async def embed(self, model, input):
+        return SimpleNamespace(data=[SimpleNamespace(embedding=list(np.linspace(-1, 1, 16)))])
+
+    async def complete(self, **kwargs):
+        self.requests.append(kwargs)
+
+        async def stream():
+            for chunk in self.chunks:
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=chunk))])
+
+        return stream()
+
+
+class FakeGroundX:
+    def __init__(self, text):
+        self.text = text
+        self.search = SimpleNamespace(content=self.content)
+
+    def content(self, id, query, **kwargs):
+        return SimpleNamespace(search=search_results(CHUNKS, text=self.text))
+
+
+@pytest.fixture
+def rag(monkeypatch, tmp_path, answer_cache, search_state):
+    llm = FakeOpenAI()
+    monkeypatch.setattr(main, "_get_openai_client", lambda: llm)
+    monkeypatch.setattr(main, "_embedding_cache", main._TTLCache())
+    llm_cache = main.diskcache.Cache(str(tmp_path / "llm"))
+    monkeypatch.setattr(main, "_llm_cache", llm_cache)
+    yield llm
+    llm_cache.close()
+
+
+def test_process_search_query_accepts_missing_search_text(rag, monkeypatch):
+    monkeypatch.setattr(main, "client", FakeGroundX(text=None))
+
+    response = asyncio.run(main.process_search_query("capital of france?"))
+
+    assert response.result == "Paris"
+    assert rag.requests[0]["messages"][0]["content"] == main.SYSTEM_PREFIX + main.SYSTEM_SUFFIX
+
+
+def test_process_search_query_answers_when_embedding_fails(rag, monkeypatch):
+    monkeypatch.setattr(main, "client", FakeGroundX(text="paris is the capital of france"))
+
+    async def embed(model, input):
+        raise RuntimeError("embeddings unavailable")
+
+    rag.embeddings = SimpleNamespace(create=embed)
+    assert asyncio.run(main.process_search_query("capital of france?")).result == "Paris"
+    assert main._answer_cache.snapshot()[0] == []
+
+    # the completion cache still works without the embedding
+    assert asyncio.run(main.process_search_query("capital of france?")).result == "Paris"
+    assert len(rag.requests) == 1
+
+
+def test_process_search_query_throttles_progress(rag, monkeypatch):
+    monkeypatch.setattr(main, "client", FakeGroundX(text="paris is the capital of france"))
+    rag.chunks = ["token "] * 500
+    progress = []
+
+    # every clock read advances 30 ms, so a report is due every few chunks
+    now = [0.0]
+
+    def monotonic():
+        now[0] += 0.03
+        return now[0]
+
+    monkeypatch.setattr(main, "time", SimpleNamespace(monotonic=monotonic))
+
+    class Ctx:
+        async def report_progress(self, value, total=None, message=None):
+            progress.append((value, message))
+
+    response = asyncio.run(main.process_search_query("capital of france?", ctx=Ctx()))
+
+    assert response.result == "token " * 500
+    assert 100 < len(progress) < 200
+    assert all(message == "token " * value for value, message in progress)
+
+
+def test_process_search_query_closes_per_call_clients(rag, monkeypatch):
+    clients = []
+
+    class ClosingOpenAI(FakeOpenAI):
+        closed = False
+
+        def __init__(self, api_key):
+            super().__init__()
+            clients.append(self)
+
+        async def close(self):
+            self.closed = True
+
+    groundx_http = []
+
+    def groundx(api_key, httpx_client):
+        groundx_http.append(httpx_client)
+        return FakeGroundX(text="paris is the capital of france")
+
+    monkeypatch.setattr(main.openai, "AsyncOpenAI", ClosingOpenAI)
+    monkeypatch.setattr(main, "GroundX", groundx)
+    config = main.SearchConfig(openai_api_key="other", groundx_api_key="other")
+
+    assert asyncio.run(main.process_search_query("capital of france?", config)).result == "Paris"
+    assert clients[0].closed
+    assert groundx_http[0].is_closed
+
+
+def test_sniff_type():
+    assert main._sniff_type("notes/README.md") == "txt"
+    assert main._sniff_type("report.PDF") == "pdf"
+    with pytest.raises(ValueError):
+        main._sniff_type("archive.zip")
+
+
+def test_ingest_documents_rejects_empty_list(monkeypatch):
+    monkeypatch.setattr(main, "client", None)
+
+    with pytest.raises(ValueError):
+        asyncio.run(main.ingest_documents([]))